@@ -27,9 +27,8 @@ try:
     import numpy as np
     from matplotlib.patches import FancyArrowPatch as Arrow
     from matplotlib.gridspec import GridSpec
-    import pylab as pl
+    import matplotlib.pyplot as pl
     import pandas as pd
-    import pysam
     from IPython.core.display import display
     from pycl.pycl import jhelp, jprint, get_package_file
 except ImportError as E:
@@ -89,18 +88,18 @@ class JGV(object):
         self.annotations = []
         self.alignments = []
 
+        # Last matplotlib style applied by the plotting methods
+        self._plot_style = None
+
     def __str__(self):
         """readable description of the object"""
-        msg = "{} instance\n".format(self.__class__.__name__)
-        msg+= "\tParameters list\n"
-        # list all values in object dict in alphabetical order
-        sorted_d = OrderedDict(sorted(self.__dict__.items(), key=lambda t: t[0]))
-        for k,v in sorted_d.items():
-            msg+="\t{}\t{}\n".format(k, v)
-        return (msg)
+        msg = ["{} instance\n".format(self.__class__.__name__), "\tParameters list\n"]
+        # list all public values in object dict in alphabetical order
+        msg.extend("\t{}\t{}\n".format(k, self.__dict__[k]) for k in sorted(self.__dict__) if not k.startswith("_"))
+        return ("".join(msg))
 
     #~~~~~~~PUBLIC SET METHODS~~~~~~~#
-    def add_annotation(self, fp, name=None, min_len=None, max_len=None, refid_list=None, type_list=None, verbose=False, **kwargs):
+    def add_annotation(self, fp, name=None, min_len=None, max_len=None, refid_list=None, type_list=None, cache=False, verbose=False, **kwargs):
         """
           * fp
             An URL to a standard genomic file containing features annotations among the following format:
@@ -120,18 +119,21 @@ class JGV(object):
             List of reference id to select. Example: ["chr1", "chr2", "chr3"] [default None]
         * type_list
             List of feature type to select. Example: ["exon", "gene"] [default None]
+        * cache
+            If True the parsed features are cached in a pickle file next to fp and reloaded next time [default False]
         """
         if verbose: jprint("Add annotation file", bold=True)
-        a = Annotation(fp=fp, name=name, min_len=min_len, max_len=max_len, refid_list=refid_list, type_list=type_list, verbose=verbose)
+        a = Annotation(fp=fp, name=name, min_len=min_len, max_len=max_len, refid_list=refid_list, type_list=type_list, cache=cache, verbose=verbose)
 
         if verbose:
-            not_found = set(self.reference.refid_list) - set(a.refid_list)
+            found = set(a.refid_list)
+            not_found = [refid for refid in self.reference.refid_list if refid not in found]
             if not_found:
                 warnings.warn("No annotation found for {}".format(",".join(not_found)))
 
         self.annotations.append(a)
 
-    def add_alignment(self, fp, name=None, min_coverage=5, refid_list=[], output_bed=False, verbose=False, **kwargs):
+    def add_alignment(self, fp, name=None, min_coverage=5, refid_list=[], output_bed=False, threads=1, verbose=False, **kwargs):
         """
          * fp
              A standard BAM or SAM (http://samtools.sourceforge.net/SAM1.pdf) containing aligned reads and a standard
@@ -154,12 +156,15 @@ class JGV(object):
               #chr21	46709983
               chr20	276516	276516	pos1	5	+
               chr20	276517	276517	pos2	5	+
+        * threads
+            Number of threads used by htslib to decompress the BAM file [ DEFAULT: 1 ]
         """
         if verbose: jprint("Add alignment file", bold=True)
-        a = Alignment(fp=fp, name=name, min_coverage=min_coverage, refid_list=refid_list, output_bed=output_bed, verbose=verbose)
+        a = Alignment(fp=fp, name=name, min_coverage=min_coverage, refid_list=refid_list, output_bed=output_bed, threads=threads, verbose=verbose)
 
         if verbose:
-            not_found = set(self.reference.refid_list) - set(a.refid_list)
+            found = set(a.refid_list)
+            not_found = [refid for refid in self.reference.refid_list if refid not in found]
             if not_found:
                 warnings.warn("No coverage found for {}".format(",".join(not_found)))
 
@@ -171,18 +176,23 @@ class JGV(object):
             warnings.warn("No annotation track loaded")
             return None
 
-        count_df = pd.DataFrame(columns=["Feature count", "Refid count", "Feature type count"])
-        rcu_df = pd.DataFrame()
-        tcu_df = pd.DataFrame()
+        count_dict = OrderedDict()
+        rcu_list = []
+        tcu_list = []
 
         for a in self.annotations:
-            count_df.loc[a.name] = [a.feature_count, a.refid_count, a.type_count]
+            count_dict[a.name] = [a.feature_count, a.refid_count, a.type_count]
             rcu = a.refid_count_uniq
             rcu.columns=[a.name]
-            rcu_df = pd.merge(left=rcu_df, right=rcu, how='outer', right_index=True, left_index=True)
+            rcu_list.append(rcu)
             tcu = a.type_count_uniq
             tcu.columns=[a.name]
-            tcu_df = pd.merge(left=tcu_df, right=tcu, how='outer', right_index=True, left_index=True)
+            tcu_list.append(tcu)
+
+        # Build the tables at once
+        count_df = pd.DataFrame.from_dict(count_dict, orient="index", columns=["Feature count", "Refid count", "Feature type count"])
+        rcu_df = pd.concat(rcu_list, axis=1, join="outer", sort=True)
+        tcu_df = pd.concat(tcu_list, axis=1, join="outer", sort=True)
 
         jprint("Counts per Annotation file", bold=True)
         display(count_df)
@@ -199,14 +209,16 @@ class JGV(object):
             warnings.warn("No alignment track loaded")
             return None
 
-        count_df = pd.DataFrame(columns=["Refid count", "Base coverage"])
-        rbc_df = pd.DataFrame()
+        count_dict = OrderedDict()
+        rbc_list = []
 
         for a in self.alignments:
-            count_df.loc[a.name] = [a.refid_count, a.nbases]
-            rbc = pd.DataFrame(a.refid_nbases)
-            rbc.columns=[a.name]
-            rbc_df = pd.merge(left=rbc_df, right=rbc, how='outer', right_index=True, left_index=True)
+            count_dict[a.name] = [a.refid_count, a.nbases]
+            rbc_list.append(a.refid_nbases.rename(a.name))
+
+        # Build the tables at once
+        count_df = pd.DataFrame.from_dict(count_dict, orient="index", columns=["Refid count", "Base coverage"])
+        rbc_df = pd.concat(rbc_list, axis=1, join="outer", sort=True)
 
         jprint("Counts per Alignment file", bold=True)
         display(count_df)
@@ -248,11 +260,7 @@ class JGV(object):
             warnings.warn("No alignment track loaded")
             return None
 
-        df = pd.DataFrame()
-        for a in self.alignments:
-            refid_df = pd.DataFrame(a.refid_nbases)
-            refid_df.columns=[a.name]
-            df = pd.merge(left=df, right=refid_df, how='outer', right_index=True, left_index=True)
+        df = pd.concat([a.refid_nbases.rename(a.name) for a in self.alignments], axis=1, join="outer", sort=True)
 
         # Filter no listed refid is requested + reorder index
         if refid_list:
@@ -263,18 +271,18 @@ class JGV(object):
 
         # Normalize by lenth and depth is requested
         if norm_depth:
-            for name, col in df.iteritems():
-                df[name] = col/col.sum()*1000
+            df = df/df.sum()*1000
         if norm_len:
-            for refid in df.index:
-                ref_len = self.reference.get_refid_len(refid)
-                df.loc[refid] = df.loc[refid]/ref_len*1000000
+            # Unknown refids get a NaN length
+            get_refid_len = self.reference.get_refid_len
+            ref_len = np.array([get_refid_len(refid) for refid in df.index], dtype=np.float64)
+            df = df.div(ref_len/1000000, axis=0)
 
         # Prepare default plotting options
-        fontsize = kwargs["fontsize"] if "fontsize" in kwargs else 12
-        color =  kwargs["color"] if "color" in kwargs else None
-        alpha = kwargs["alpha"] if "alpha" in kwargs else 1
-        pl.style.use(plot_style)
+        fontsize = kwargs.get("fontsize", 12)
+        color = kwargs.get("color", None)
+        alpha = kwargs.get("alpha", 1)
+        self._set_plot_style(plot_style)
 
         # Plot data
         fig, ax = pl.subplots(figsize=(figwidth, figheight))
@@ -393,18 +401,27 @@ class JGV(object):
         if self.annotations:
             if verbose: jprint ("Extract annotation data", bold=True)
             for a in self.annotations:
-                annotation_dict[a.name] = a.interval_features(
+                track_df = a.interval_features(
                     refid=refid, start=start, end=end, feature_types=feature_types,
                     max_features_per_type=max_features_per_type)
+                # Split the features by type once, the groups give both the number of rows and the data to plot.
+                # The rows of each type are found with a stable sort of the type codes
+                type_groups = []
+                if not track_df.empty:
+                    codes, type_names = pd.factorize(track_df["type"], sort=True)
+                    order = np.argsort(codes, kind="stable")
+                    for type_name, rows in zip(type_names, np.split(order, np.cumsum(np.bincount(codes))[:-1])):
+                        type_groups.append((type_name, track_df.iloc[rows]))
+                annotation_dict[a.name] = type_groups
                 # Take empty df into account for ploting
-                n = 1 if annotation_dict[a.name].empty else annotation_dict[a.name].type.nunique()
+                n = max(1, len(type_groups))
                 # +1 for space bewtween tracks
                 figheight += n*annotation_track_height+1
 
         # Create a pylot figure object with an empty grid
         fig = pl.figure (figsize= (figwidth, figheight))
         grid = GridSpec (nrows=figheight, ncols=1, hspace=0.5)
-        pl.style.use (plot_style)
+        self._set_plot_style (plot_style)
 
         # Curent height marker
         h = 0
@@ -422,17 +439,22 @@ class JGV(object):
                 ax.xaxis.set_tick_params(bottom=False, top=False, labelbottom=False, labeltop=False)
                 ax.set_ylabel(track_name)
 
+                # Pass numpy arrays to matplotlib rather than python lists
+                x = track_df.index.to_numpy()
+                pos = track_df["+"].to_numpy()
+                neg = track_df["-"].to_numpy()
+
                 # Plot the positive strand
-                if track_df["+"].sum () == 0:
+                if not np.any(pos):
                     ax.text(0.5, 0.6,'No Coverage on the + strand', ha='center', va='center', transform=ax.transAxes)
                 else:
-                    ax.fill_between(x=track_df.index, y1=0, y2=list(track_df["+"]),
+                    ax.fill_between(x=x, y1=0, y2=pos,
                         alpha=alignment_alpha, color=alignment_color[0], label="Positive strand")
                 # Plot the negative strand
-                if track_df["-"].sum () == 0:
+                if not np.any(neg):
                     ax.text(0.5, 0.4,'No Coverage on the - strand', ha='center', va='center', transform=ax.transAxes)
                 else:
-                    ax.fill_between(x=track_df.index, y1=0, y2=list(track_df["-"]),
+                    ax.fill_between(x=x, y1=0, y2=neg,
                         alpha=alignment_alpha, color=alignment_color[1], label="Negative strand")
                 # If elements were added to the ax
                 if ax.collections: ax.legend(bbox_to_anchor=(1, 1), loc=2,frameon=False)
@@ -441,12 +463,12 @@ class JGV(object):
             ax.xaxis.set_tick_params(bottom=True, labelbottom=True)
 
         if self.annotations:
-            for track_name, track_df in annotation_dict.items():
+            for track_name, type_groups in annotation_dict.items():
                 h+=1
                 if verbose: jprint ("\tAlignment track name: {}".format(track_name))
 
                 # No feature case
-                if track_df.empty:
+                if not type_groups:
                     ax = pl.subplot(grid[h:h+annotation_track_height])
                     ax.set_xlim((start, end))
                     ax.text(0.5, 0.5,'No feature found', ha='center', va='center', transform=ax.transAxes)
@@ -460,7 +482,7 @@ class JGV(object):
                 # General case
                 else:
                     first=True
-                    for feature_type, feature_df in track_df.groupby("type"):
+                    for feature_type, feature_df in type_groups:
 
                         # Prepare the ploting area
                         ax = pl.subplot(grid[h:h+annotation_track_height])
@@ -472,18 +494,19 @@ class JGV(object):
                         ax.grid(axis="y", b=False)
                         ax.set_ylabel(feature_type)
 
-                        # Compute the non overlaping level where to plot the arrow
+                        # Compute the non overlaping level where to plot the arrow for all the features at once. The
+                        # columns are extracted as lists of python objects rather than boxing each row in a Series
                         level = Level(offset=annotation_offset)
-                        for n, feature in feature_df.iterrows():
-                            fl = level(feature.ID, feature.start, feature.end, feature.strand)
-                            if fl:
-                                ax.add_patch( Arrow( posA=[fl.start, fl.level], posB=[fl.end, fl.level], linewidth=3,
-                                    color=annotation_color, arrowstyle=fl.arrowstyle))
-                                if annotation_label:
-                                    text_end = fl.end if fl.end < end-annotation_offset else end-annotation_offset
-                                    text_start = fl.start if fl.start > start+annotation_offset else start+annotation_offset
-                                    text = fl.ID[0:max_label_size]+"..." if len(fl.ID) > max_label_size else fl.ID
-                                    ax.text (x=text_start+ (text_end-text_start)/2, y=fl.level, s=text, ha="center", fontsize=8)
+                        enhanced_features = level.assign_levels(feature_df["ID"].tolist(), feature_df["start"].tolist(),
+                            feature_df["end"].tolist(), feature_df["strand"].tolist())
+                        for fl in enhanced_features:
+                            ax.add_patch( Arrow( posA=[fl.start, fl.level], posB=[fl.end, fl.level], linewidth=3,
+                                color=annotation_color, arrowstyle=fl.arrowstyle))
+                            if annotation_label:
+                                text_end = fl.end if fl.end < end-annotation_offset else end-annotation_offset
+                                text_start = fl.start if fl.start > start+annotation_offset else start+annotation_offset
+                                text = fl.ID[0:max_label_size]+"..." if len(fl.ID) > max_label_size else fl.ID
+                                ax.text (x=text_start+ (text_end-text_start)/2, y=fl.level, s=text, ha="center", fontsize=8)
 
                         ax.set_ylim(level.min_level-0.5, level.max_level+0.5)
 
@@ -493,3 +516,10 @@ class JGV(object):
                             first = False
                     # Last elemet exception
                     ax.xaxis.set_tick_params(bottom=True, labelbottom=True)
+
+    #~~~~~~~PRIVATE METHODS~~~~~~~#
+    def _set_plot_style (self, plot_style):
+        """Apply a matplotlib style only if it is not the last one applied, as loading a style resets many rcParams"""
+        if plot_style != self._plot_style:
+            pl.style.use(plot_style)
+            self._plot_style = plot_style
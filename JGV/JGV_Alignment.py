@@ -2,7 +2,7 @@
 
 # Standard library imports
 from collections import OrderedDict, Counter
-import gzip
+from io import TextIOWrapper
 
 # Third party import
 import pysam
@@ -17,12 +17,20 @@ class Alignment(object):
     Can return the coverage for a given interval
     """
 
+    # Maximal cumulated length of the selected references tallied in dense arrays when the file is not sorted by
+    # coordinates, which costs 2 GB for both strands. Longer genomes are tallied in sparse Counters
+    _MAX_UNSORTED_DENSE_LEN = 250000000
+
     #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
-    def __init__ (self, fp, name=None, min_coverage=5, refid_list=[], output_bed=False, verbose=False, **kwargs):
+    def __init__ (self, fp, name=None, min_coverage=5, refid_list=[], output_bed=False, threads=1, verbose=False, **kwargs):
         """
          * fp
              A standard BAM or SAM (http://samtools.sourceforge.net/SAM1.pdf) containing aligned reads and a standard
-             header. The files do not need to be sorted or indexed.
+             header. The files do not need to be sorted or indexed. The coverage is tallied in a 4 bytes per base array
+             for each reference and strand. If the file is sorted by coordinates (@HD SO:coordinate) the arrays of a
+             reference are released once all its reads are counted, otherwise they are all kept until the end of the
+             file. For unsorted files with more than 250 Mb of selected references, the coverage is tallied in sparse
+             Counters instead, which is slower but only grows with the number of covered positions.
              One can also use a 6 fields bed (chrom, chromStart, chromEnd, name, score, strand, where score is the
              coverage value (Much faster than from a Bam/Sam file, can be gzipped). http://www.ensembl.org/info/website/upload/bed.html
         *  name
@@ -38,6 +46,8 @@ class Alignment(object):
             If True will be write a 6 columns compressed bed file containing the coverage values for + and - strand
             excluding positions with coverage lesser than min_coverage.the option will apply only is the input file is
             BAM or SAM. [ DEFAULT: False ]
+        * threads
+            Number of threads used by htslib to decompress the BAM file [ DEFAULT: 1 ]
         """
         # Verify that the file is readable
         is_readable_file(fp)
@@ -47,19 +57,20 @@ class Alignment(object):
         self.name = name if name else file_basename(fp)
         self.ext = extensions_list(fp)[0]
         self.nbases = 0
+        self._refid_nbases = None
 
         if self.ext in ["bam","sam"]:
             if verbose: jprint ("Compute coverage from bam/sam file ", self.fp)
-            self.d = self._bam_parser(fp, min_coverage, refid_list)
+            self.d = self._bam_parser(fp, min_coverage, refid_list, threads=threads, verbose=verbose)
             if output_bed:
                 outfp = "{}/{}.bed.gz".format(dir_path(fp), file_basename(fp))
                 if verbose: jprint ("Write coverage data in file ", outfp)
-                self._write_coverage_file (outfp)
+                self._write_coverage_file (outfp, verbose=verbose)
                 self.outfp=outfp
 
         elif self.ext == "bed":
             if verbose: jprint ("Extract coverage from bed file", self.fp)
-            self.d = self._bed_parser(fp, min_coverage, refid_list)
+            self.d = self._bed_parser(fp, min_coverage, refid_list, verbose=verbose)
 
         else:
             msg = "The file is not in SAM/BAM/BED format. Please provide a correctly formated file"
@@ -71,11 +82,11 @@ class Alignment(object):
     def __str__(self):
         msg = "{} instance\n".format(self.__class__.__name__)
         # list all values in object dict in alphabetical order
-        for k,v in OrderedDict(sorted(self.__dict__.items(), key=lambda t: t[0])).items():
+        for k,v in sorted(self.__dict__.items(), key=lambda t: t[0]):
             if k == "d":
                 for refid, refval in v.items():
                     msg+="\t{}\tnbases:{}\n".format(refid, refval["nbases"])
-            else:
+            elif not k.startswith("_"):
                 msg+="\t{}\t{}\n".format(k, v)
         return (msg)
 
@@ -93,10 +104,11 @@ class Alignment(object):
     def refid_nbases(self):
         """List of unique reference sequence ids found associated with their base coverage
         """
-        s = pd.Series(name="nbases")
-        for refid, refval in self.d.items():
-            s.loc[refid] = refval["nbases"]
-        return s.sort_values(ascending=False)
+        # The coverage data do not change after parsing, so the Series is built once
+        if self._refid_nbases is None:
+            s = pd.Series(OrderedDict((refid, refval["nbases"]) for refid, refval in self.d.items()), name="nbases", dtype=np.int64)
+            self._refid_nbases = s.sort_values(ascending=False)
+        return self._refid_nbases
 
     @property
     def refid_count (self):
@@ -105,57 +117,106 @@ class Alignment(object):
         return len(self.d)
 
     #~~~~~~~PRIVATE METHODS~~~~~~~#
-    def _bam_parser(self, fp, min_coverage=5, refid_list= [], verbose=False, **kwargs):
+    def _bam_parser(self, fp, min_coverage=5, refid_list= [], threads=1, verbose=False, **kwargs):
         """Parse a sam or bam formated file
         """
         d = OrderedDict()
-        with pysam.AlignmentFile(fp) as bam:
-            # Compute the genomic coverage for each reads
+        # Extra htslib threads decompress the BGZF blocks while the reads are being iterated
+        with pysam.AlignmentFile(fp, threads=threads) as bam:
+
+            # Compute the genomic coverage for each reads in dense arrays sized with the header lengths
+            # The arrays are keyed by (reference index, is_reverse) to keep the work per read minimal
             if verbose: jprint ("\tTally coverage for each base")
+            refid_len = bam.lengths
+            tally = {}
+            # In coordinate sorted files the reads of a reference are contiguous, so the dense arrays of a reference
+            # can be thresholded and released as soon as the next reference starts
+            coord_sorted = bam.header.to_dict().get("HD", {}).get("SO") == "coordinate"
+            # Otherwise all the arrays are kept until the end, so sparse Counters are used for large genomes
+            selected_len = sum(l for refid, l in zip(bam.references, refid_len) if not refid_list or refid in refid_list)
+            dense = coord_sorted or selected_len <= self._MAX_UNSORTED_DENSE_LEN
+            if verbose and not dense: jprint ("\tFile not sorted by coordinates, use a sparse tally")
+            last_idx = -1
+            compacted = set()
             for line in bam:
+                refid_idx = line.reference_id
                 # Skip non aligned reads
-                if line.reference_id == -1:
+                if refid_idx == -1:
                     continue
-                refid = line.reference_name
-                # If not refid filter or if the refid is in the autozized list
-                if not refid_list or refid in refid_list:
-                    # Create a new entry if not in the dict
-                    if not refid in d:
-                        d[refid] = {"nbases":0, "+":Counter(), "-":Counter()}
-                    # Save coverage
-                    strand = "-" if line.is_reverse else "+"
-                    for position in line.get_reference_positions():
-                        d[refid][strand][position] += 1
+                if coord_sorted and refid_idx != last_idx:
+                    # The header cannot be trusted blindly, a compacted reference would be silently miscounted
+                    if refid_idx in compacted:
+                        raise ValueError("The reads of {} are not contiguous although the file header declares a coordinate sort order".format(
+                            bam.get_reference_name(refid_idx)))
+                    self._compact_tally (tally, last_idx, min_coverage)
+                    compacted.add(last_idx)
+                    last_idx = refid_idx
+                key = (refid_idx, line.is_reverse)
+                if not key in tally:
+                    # The tally is only allocated with the first read of a reference, so references without mapped
+                    # reads cost nothing
+                    # If not refid filter or if the refid is in the autozized list, else flag the key with None
+                    refid = bam.get_reference_name(refid_idx)
+                    if not refid_list or refid in refid_list:
+                        tally[key] = np.zeros(refid_len[refid_idx], dtype=np.int32) if dense else Counter()
+                    else:
+                        tally[key] = None
+                coverage = tally[key]
+                # Save coverage for each aligned block of the read, as given by its CIGAR string
+                if coverage is not None:
+                    if dense:
+                        for block_start, block_end in line.get_blocks():
+                            coverage[block_start:block_end] += 1
+                    else:
+                        for block_start, block_end in line.get_blocks():
+                            coverage.update(range(block_start, block_end))
+
+            # Collect the arrays, or Series for compacted references and Counters, per refid in order of appearance
+            for (refid_idx, is_reverse), coverage in tally.items():
+                if coverage is None:
+                    continue
+                if isinstance(coverage, Counter):
+                    coverage = pd.Series(coverage, dtype=np.int64)
+                refid = bam.get_reference_name(refid_idx)
+                if not refid in d:
+                    d[refid] = {"nbases":0, "+":np.zeros(0, dtype=np.int32), "-":np.zeros(0, dtype=np.int32)}
+                d[refid]["-" if is_reverse else "+"] = coverage
 
         d = self._clean_d (d=d, min_coverage=min_coverage, verbose=verbose)
         return d
 
+    def _compact_tally (self, tally, refid_idx, min_coverage=5, **kwargs):
+        """Replace the dense coverage arrays of both strands of a reference by Series of the positions with a coverage
+        above threshold, to free the memory of the dense arrays
+        """
+        for is_reverse in [False, True]:
+            coverage = tally.get((refid_idx, is_reverse))
+            if isinstance(coverage, np.ndarray):
+                positions = np.flatnonzero(coverage >= min_coverage)
+                tally[(refid_idx, is_reverse)] = pd.Series(coverage[positions].astype(np.int64), index=positions)
+
     def _bed_parser (self, fp, min_coverage=5, refid_list= [], verbose=False, **kwargs):
         """Extract data from a coverage bad file
         """
         d = OrderedDict()
 
-        # File handling for both uncompressed or compressed fasta file
-        if fp.endswith(".gz"):
-            open_fun, open_mode = gzip.open, "rt"
-        else:
-            open_fun, open_mode = open, "r"
-        # Parse fasta file refid
-        with open_fun(fp, open_mode) as fin:
-            if verbose: jprint ("\tExtract base coverage data")
-            for line in fin:
-                sl = line[0:-1].split("\t")
-                refid = sl[0]
-                if not refid_list or refid in refid_list:
-                    # Create a new entry if not in the dict
-                    if not refid in d:
-                        d[refid] = {"nbases":0, "+":Counter(), "-":Counter()}
-                    position = int(sl[1])
-                    coverage = int(sl[4])
-                    strand = sl[5]
-                    d[refid][strand][position] = coverage
-                    d[refid]["nbases"] += coverage
-                    self.nbases += coverage
+        # Parse the whole file at once with the pandas C parser. Compressed files are handled transparently
+        if verbose: jprint ("\tExtract base coverage data")
+        try:
+            df = pd.read_csv(fp, sep="\t", comment="#", header=None, usecols=[0,1,4,5], names=["refid","start","coverage","strand"],
+                dtype={"refid":str, "start":np.int64, "coverage":np.int64, "strand":str}, engine="c")
+        # Empty or comment only files do not contain any coverage
+        except pd.errors.EmptyDataError:
+            if verbose: jprint ("\tNo coverage data found in the file")
+            return d
+        if refid_list:
+            df = df[df["refid"].isin(refid_list)]
+
+        # Split the coverage per refid and strand in order of appearance
+        for (refid, strand), strand_df in df.groupby(["refid","strand"], sort=False):
+            if not refid in d:
+                d[refid] = {"nbases":0, "+":pd.Series(dtype=np.int64), "-":pd.Series(dtype=np.int64)}
+            d[refid][strand] = pd.Series(strand_df["coverage"].values, index=strand_df["start"].values)
 
         d = self._clean_d (d=d, min_coverage=min_coverage, verbose=verbose)
         return d
@@ -166,35 +227,49 @@ class Alignment(object):
         if verbose: jprint ("\tFilter and sort the coverage results by position")
         for refid in d.keys():
             for strand in ["+","-"]:
-                s = OrderedDict()
-                for position, coverage in d[refid][strand].items():
-                    if coverage >= min_coverage:
-                        s[position] = coverage
-                        self.nbases += coverage
-                        d[refid]["nbases"] += coverage
-                d[refid][strand] = pd.Series(s)
-                d[refid][strand].sort_index(inplace=True)
+                coverage = d[refid][strand]
+                # Dense arrays are indexed by position and thus already sorted
+                if isinstance(coverage, np.ndarray):
+                    positions = np.flatnonzero(coverage >= min_coverage)
+                    s = pd.Series(coverage[positions].astype(np.int64), index=positions)
+                # Series parsed from bed files are filtered then sorted by position
+                else:
+                    s = coverage[coverage.values >= min_coverage].sort_index()
+                nbases = int(s.sum())
+                self.nbases += nbases
+                d[refid]["nbases"] += nbases
+                d[refid][strand] = s
+                # Keep raw numpy views of the positions and coverage for the interval queries
+                d[refid][strand+"_pos"] = s.index.values.astype(np.int64, copy=False)
+                d[refid][strand+"_cov"] = s.values
         return d
 
     def _write_coverage_file (self, outfp, buf_size=8192, verbose=False, **kwargs):
-        """Bufferized writer for the coverage bed file
+        """Write the coverage bed file in BGZF format, which is still readable as a standard gzip file, and index it
+        with tabix to allow random access to genomic regions
+        """
+        with TextIOWrapper (pysam.BGZFile (outfp, "wb")) as out:
+            self._write_coverage_lines (out, buf_size=buf_size)
+        if verbose: jprint ("\tIndex output with tabix")
+        pysam.tabix_index (outfp, preset="bed", force=True)
+
+    def _write_coverage_lines (self, out, buf_size=8192, **kwargs):
+        """Bufferized writer for the coverage bed lines. Each refid is formatted at once by pandas, with both strands
+        merged and sorted by position as required by tabix
         """
-        with gzip.open (outfp, "wt") as out:
-            # Write header containing chromosome information\t
-            # Bufferized writing of lines
-            i = 0
-            str_buf = ""
-            for refid, refval in self.d.items():
-                for strand in ["+","-"]:
-                    for position, coverage in refval[strand].items():
-                        i+=1
-                        str_buf += "{0}\t{1}\t{1}\tpos{2}\t{3}\t{4}\n".format(refid, position, i, coverage, strand)
-                        if i%buf_size == 0:
-                            out.write(str_buf)
-                            str_buf = ""
-            # Empty the rest of the buffer
-            out.write(str_buf)
-            str_buf = ""
+        i = 0
+        for refid, refval in self.d.items():
+            strand_dfs = [pd.DataFrame({"start":refval[strand].index, "coverage":refval[strand].values, "strand":strand})
+                for strand in ["+","-"] if not refval[strand].empty]
+            if not strand_dfs:
+                continue
+            df = pd.concat(strand_dfs)
+            df = df.sort_values("start", kind="mergesort")
+            df.insert(0, "refid", refid)
+            df.insert(2, "end", df["start"].values)
+            df.insert(3, "name", ("pos" + pd.Series(np.arange(i+1, i+len(df)+1)).astype(str)).values)
+            df.to_csv(out, sep="\t", header=False, index=False, chunksize=buf_size)
+            i += len(df)
 
     #~~~~~~~PUBLIC METHODS~~~~~~~#
     def interval_coverage (self, refid, start, end, bins=500, bin_repr_fun = "max", verbose=False, **kwargs):
@@ -219,7 +294,6 @@ class Alignment(object):
             Function to represent each bin ("max", "mean" and "sum") [ DEFAULT: "max" ]
         """
         if verbose: jprint ("Compute coverage from the windows: {}:{}-{}".format(refid, start, end))
-        df = pd.DataFrame(columns=["+", "-"], dtype=int)
 
         # Adjust number of bins and calculate step
         if bins > end-start:
@@ -228,29 +302,41 @@ class Alignment(object):
         step = (end-start)/bins
         if verbose: jprint ("\tDefine size of each bin: {}".format(step))
 
+        # Define the start and end of all the windows from bins+1 integer edges. Contrary to a float arange, it always
+        # gives exactly bins contiguous windows ending at end
+        edges = np.linspace (start, end, bins+1).astype(np.int64)
+        winstarts = edges[:-1]
+        winends = edges[1:]
+
         # If refid is not in the self refid-list
-        if not refid in self.refid_list:
+        if not refid in self.d:
             if verbose: jprint ("\tThe reference {} is not in the list of references with alignment".format(refid))
-            for i in np.arange (start, end, step):
-                for strand in ["+","-"]:
-                    df.loc[int(i), strand] =  0
-            return df
+            return pd.DataFrame({"+":np.zeros(len(winstarts), dtype=np.int64), "-":np.zeros(len(winstarts), dtype=np.int64)},
+                index=winstarts, columns=["+", "-"])
 
-        # Select positions windows and get maximun
+        # Compute all the windows at once. Positions are sorted, so the slice of covered positions falling in each
+        # window is found by binary search and the windows are reduced in a single pass
         if verbose: jprint ("\tCompute coverage...")
-        for i in np.arange (start, end, step):
-            winstart = int(i)
-            winend = int(i+step)
-            for strand in ["+","-"]:
-                l = self.d[refid][strand][(self.d[refid][strand].index >= winstart)&(self.d[refid][strand].index < winend)]
-                if l.empty:
-                    df.loc[winstart, strand] =  0
-                elif bin_repr_fun == "max":
-                    df.loc[winstart, strand] = l.max()
-                elif bin_repr_fun == "sum":
-                    df.loc[winstart, strand] = l.sum()
-                elif bin_repr_fun == "mean":
-                    df.loc[winstart, strand] = l.sum()/step
+        refval = self.d[refid]
+        bin_cov = OrderedDict()
+        for strand in ["+","-"]:
+            positions = refval[strand+"_pos"]
+            coverage = refval[strand+"_cov"]
+            lo = np.searchsorted(positions, winstarts)
+            hi = np.searchsorted(positions, winends)
+            if bin_repr_fun == "max":
+                # Reduce over interleaved [lo, hi) boundaries. The padding value allows hi to be equal to the array length
+                bin_cov[strand] = np.maximum.reduceat(np.append(coverage, 0), np.ravel([lo, hi], order="F"))[::2]
+                bin_cov[strand][lo == hi] = 0
+            elif bin_repr_fun in ["sum", "mean"]:
+                cumsum = np.append(0, np.cumsum(coverage))
+                bin_cov[strand] = cumsum[hi]-cumsum[lo]
+                if bin_repr_fun == "mean":
+                    bin_cov[strand] = bin_cov[strand]/step
+            else:
+                raise ValueError("Invalid bin_repr_fun {}. Valid values are max, sum and mean".format(bin_repr_fun))
+        df = pd.DataFrame(bin_cov, index=winstarts)
+
         if verbose:
             if df["+"].sum() + df["-"].sum() == 0:
                 jprint ("\tNull coverage for both strands in the requested interval")
@@ -3,9 +3,12 @@
 # Strandard library imports
 from collections import OrderedDict
 from os import access, R_OK
+from os.path import isfile, getmtime
+import warnings
 
 # Third party import
 import pandas as pd
+import numpy as np
 from pycl.pycl import extensions_list, has_extension, file_basename, jprint, is_readable_file
 
 #~~~~~~~CLASS~~~~~~~#
@@ -15,9 +18,16 @@ class Annotation(object):
     Can return the list of annotations for a given interval
     """
 
+    # Columns to import from the annotation files and explicit dtypes for the text columns
+    _GFF_USECOLS = ["refid","type","start","end","score","strand","attribute"]
+    _BED_USECOLS = ["refid","start","end","ID","score","strand"]
+    _STR_DTYPES = {"refid":str, "type":str, "strand":str, "ID":str, "attribute":str}
+    # Version of the cache file layout, to increment whenever the parsed feature_df changes (columns, dtypes...)
+    _CACHE_VERSION = 2
+
     #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
 
-    def __init__ (self, fp, name=None, min_len=None, max_len=None, refid_list=None, type_list=None, verbose=False, **kwargs):
+    def __init__ (self, fp, name=None, min_len=None, max_len=None, refid_list=None, type_list=None, cache=False, verbose=False, **kwargs):
         """
          * fp
             A path to a standard genomic file containing features annotations among the following format
@@ -34,6 +44,11 @@ class Annotation(object):
             List of reference id to select. Example: ["chr1", "chr2", "chr3"] [default None]
         * type_list
             List of feature type to select. Example: ["exon", "gene"] [default None]
+        * cache
+            If True the parsed features are saved in a pickle file next to fp (fp + .cache.pkl) before any filtering.
+            The next time the same file is opened, the cache is loaded instead of parsing fp again, unless fp was
+            modified after the cache was written. If the cache file cannot be written, for example in a read only
+            directory, a warning is emitted and the features are used as parsed [default False]
         """
         if verbose: jprint ("Parse Annotation file")
         # Verify that the file is readable
@@ -53,21 +68,36 @@ class Annotation(object):
             compression=None
             ext_pos=-1
 
-        # Find extension type
-        if has_extension (fp, pos=ext_pos, ext="gtf"):
-            self.feature_df = self._gtf_parser(fp=fp, compression=compression, verbose=verbose)
-        elif has_extension (fp, pos=ext_pos, ext="gff3"):
-            self.feature_df = self._gff3_parser(fp=fp, compression=compression, verbose=verbose)
-        elif has_extension (fp, pos=ext_pos, ext="bed"):
-            self.feature_df = self._bed_parser(fp=fp, compression=compression, verbose=verbose)
+        # The refid selection is done while parsing to skip the other references early, unless all the features have
+        # to be cached
+        if type(refid_list) == str:
+            refid_list = [refid_list]
+        parser_refid_list = None if cache else refid_list
+
+        # Reuse the cached features if possible, else parse the file
+        cache_fp = fp+".cache.pkl"
+        self.feature_df = self._load_cache(fp=fp, cache_fp=cache_fp, verbose=verbose) if cache else None
+        if self.feature_df is None:
+
+            # Find extension type
+            if has_extension (fp, pos=ext_pos, ext="gtf"):
+                self.feature_df = self._gtf_parser(fp=fp, compression=compression, refid_list=parser_refid_list, verbose=verbose)
+            elif has_extension (fp, pos=ext_pos, ext="gff3"):
+                self.feature_df = self._gff3_parser(fp=fp, compression=compression, refid_list=parser_refid_list, verbose=verbose)
+            elif has_extension (fp, pos=ext_pos, ext="bed"):
+                self.feature_df = self._bed_parser(fp=fp, compression=compression, refid_list=parser_refid_list, verbose=verbose)
+
+            # Else try to import as a pickled file
+            else:
+                try:
+                    self.feature_df = self._pickle_parser(fp=fp, verbose=verbose)
+                # If invalid file format
+                except Exception as E:
+                    raise ValueError("Cannot open file or the file is not in a valid format")
 
-        # Else try to import as a pickled file
-        else:
-            try:
-                self.feature_df = self._pickle_parser(fp=fp, verbose=verbose)
-            # If invalid file format
-            except Exception as E:
-                raise ValueError("Cannot open file or the file is not in a valid format")
+            # Write the parsed features in the cache file for quicker loading next time
+            if cache:
+                self._write_cache(cache_fp=cache_fp, verbose=verbose)
 
         # Optional filterig steps
         if min_len or max_len:
@@ -79,8 +109,12 @@ class Annotation(object):
 
         # Sort the dataframe and reset index
         if verbose: jprint("Sorting and final cleanup")
-        self.feature_df.sort_values(by=["refid","start","end"], inplace=True)
-        self.feature_df.reset_index(drop=True, inplace=True)
+        # Sort with numpy on the integer codes of the refids. The categories are sorted, so the order is the same as
+        # a sort on the refid strings
+        refid_codes = pd.Categorical(self.feature_df["refid"]).codes
+        order = np.lexsort((self.feature_df["end"].values, self.feature_df["start"].values, refid_codes))
+        self.feature_df = self.feature_df.iloc[order].reset_index(drop=True)
+        self._refid_index = None
 
         if verbose: jprint("\tNumber of features imported: {}".format(self.feature_count))
 
@@ -96,7 +130,7 @@ class Annotation(object):
     @property
     def refid_count(self):
         """Number of unique reference sequence ids found"""
-        return self.feature_df["refid"].nunique()
+        return len(self._get_refid_index())
 
     @property
     def type_count(self):
@@ -106,7 +140,7 @@ class Annotation(object):
     @property
     def refid_list(self):
         """List of unique reference sequence ids found"""
-        return set(self.feature_df["refid"])
+        return set(self._get_refid_index())
 
     @property
     def type_list(self):
@@ -116,12 +150,14 @@ class Annotation(object):
     @property
     def refid_count_uniq(self):
         """List of unique reference sequence ids with count of associated features"""
-        return pd.DataFrame(self.feature_df.groupby("refid").size().sort_values(ascending=False), columns=["count"])
+        counts = self.feature_df["refid"].value_counts()
+        return counts[counts > 0].to_frame("count")
 
     @property
     def type_count_uniq(self):
         """List of unique feature types with count of associated features"""
-        return pd.DataFrame(self.feature_df.groupby("type").size().sort_values(ascending=False), columns=["count"])
+        counts = self.feature_df["type"].value_counts()
+        return counts[counts > 0].to_frame("count")
 
     #~~~~~~~PUBLIC METHODS~~~~~~~#
 
@@ -147,31 +183,35 @@ class Annotation(object):
             be performed. If None, all the features will be returned [ DEFAULT: None ]
         """
         # Verifications and auto adjustment of coordinates
-        if not refid in self.refid_list:
+        refid_index = self._get_refid_index()
+        if not refid in refid_index:
             if verbose: jprint ("The reference {} is not in the list of references with alignment".format(refid))
             return pd.DataFrame(columns=["refid","start","end","strand","ID","type"])
 
-        # Select the refid and coordinates
-        df = self.feature_df[(self.feature_df["refid"] == refid)&(self.feature_df["end"] > start)&(self.feature_df["start"] < end)]
+        # Select the refid and coordinates. Features are sorted by start and max_ends is the running maximum of their
+        # end coordinates, so the candidate features are in a contiguous slice bounded by 2 binary searches. Only the
+        # candidates are then tested for their end coordinate
+        rows, starts, ends, max_ends = refid_index[refid]
+        first = np.searchsorted(max_ends, start, side="right")
+        last = np.searchsorted(starts, end, side="left")
+        df = self.feature_df.iloc[rows[first:last][ends[first:last] > start]]
         if df.empty:
             if verbose: jprint ("No feature found in the requested interval")
             return pd.DataFrame(columns=["refid","start","end","strand","ID","type"])
 
-        # Cast str to list
+        # Cast str to list and filter by type once, before grouping
         if type(feature_types) == str: feature_types = [feature_types]
+        if feature_types:
+            df = df[df["type"].isin(feature_types)]
 
-        # Filter_df by type and max number per type
+        # Filter_df by max number per type
         select_list = []
-        for type_name, type_df in df.groupby("type"):
-            # Filter out if not in the list
-            if not feature_types or type_name in feature_types:
-                sdf = df[(df["type"] == type_name)]
-                if sdf.empty:
-                    if verbose: jprint ("No feature of type {} found in the requested interval".format(type_name))
-                elif max_features_per_type and len(sdf)>max_features_per_type:
-                    select_list.append(sdf.sample(max_features_per_type))
-                else:
-                    select_list.append(sdf)
+        for type_name, type_df in df.groupby("type", observed=True):
+            # The groups are already the features of the type
+            if max_features_per_type and len(type_df)>max_features_per_type:
+                select_list.append(type_df.sample(max_features_per_type))
+            else:
+                select_list.append(type_df)
         # Merge the selected features in a single df
         if select_list:
             df = pd.concat(select_list)
@@ -179,9 +219,47 @@ class Annotation(object):
             if verbose: jprint ("No feature found in the requested interval")
             return pd.DataFrame(columns=["refid","start","end","strand","ID","type"])
 
-        # Return a sorted copy of the  df
+        # Return the sorted df. concat already created a new frame, so no extra copy is needed
         df.sort_values(by=["refid","start","end"], inplace=True)
-        return df.copy().reset_index(drop=True)
+        return df.reset_index(drop=True)
+
+    def interval_features_batch (self, refid, starts, ends, feature_types=None, verbose=False, **kwargs):
+        """
+        Find the features overlapping each interval of a list of intervals for a given refid. The binary searches are
+        done for all the intervals at once. Return a list containing for each interval an array of the positions of
+        the overlapping features in feature_df, that can be used with feature_df.iloc
+        * refid
+            Name of the sequence from the original fasta file
+        * starts
+            List or array of start coordinates of the intervals
+        * ends
+            List or array of end coordinates of the intervals
+        * feature_types
+            Name of a valid feature type ( "exon"|"transcript"|"gene"|"CDS"...) or list of names of feature type to
+            select. If not given, all features type found in the intervals will be returned [ DEFAULT: None ]
+        """
+        starts = np.asarray(starts)
+        ends = np.asarray(ends)
+
+        # Verifications
+        refid_index = self._get_refid_index()
+        if not refid in refid_index:
+            if verbose: jprint ("The reference {} is not in the list of references with alignment".format(refid))
+            return [np.zeros(0, dtype=np.int64) for _ in range(len(starts))]
+
+        # Bound the candidate features of all the intervals at once, then test the end coordinates of the candidates
+        rows, feature_starts, feature_ends, max_ends = refid_index[refid]
+        firsts = np.searchsorted(max_ends, starts, side="right")
+        lasts = np.searchsorted(feature_starts, ends, side="left")
+        hits_list = [rows[first:last][feature_ends[first:last] > start] for first, last, start in zip(firsts, lasts, starts)]
+
+        # Filter by type. Only the types of the hits are tested, not the whole feature_df
+        if feature_types and hits_list:
+            if type(feature_types) == str: feature_types = [feature_types]
+            valid_type = self.feature_df["type"].iloc[np.concatenate(hits_list)].isin(feature_types).values
+            valid_type_list = np.split(valid_type, np.cumsum([len(hits) for hits in hits_list])[:-1])
+            hits_list = [hits[valid] for hits, valid in zip(hits_list, valid_type_list)]
+        return hits_list
 
     def select_len (self, min_len=None, max_len=None, verbose=False, **kwargs):
         """ Select features longer or shorter that given values
@@ -196,6 +274,7 @@ class Annotation(object):
         # Filter max len
         if max_len:
             self.feature_df = self.feature_df[((self.feature_df["end"]-self.feature_df["start"]) <= max_len)]
+        self._refid_index = None
         if verbose: jprint ("\tFeatures after maximal length filtering: {}".format(self.feature_count))
 
     def select_references (self, refid_list, verbose=False, **kwargs):
@@ -209,6 +288,7 @@ class Annotation(object):
             jprint ("Selecting features based on reference id")
             jprint ("\tFeatures before filtering: {}".format(self.feature_count))
         self.feature_df = self.feature_df[(self.feature_df["refid"].isin(refid_list))]
+        self._refid_index = None
         if verbose: jprint ("\tFeatures after filtering: {}".format(self.feature_count))
 
     def select_types (self, type_list, verbose=False, **kwargs):
@@ -222,6 +302,7 @@ class Annotation(object):
             jprint ("Selecting features based on type")
             jprint ("\tFeatures before filtering: {}".format(self.feature_count))
         self.feature_df = self.feature_df[(self.feature_df["type"].isin(type_list))]
+        self._refid_index = None
         if verbose: jprint ("\tFeatures after filtering: {}".format(self.feature_count))
 
     def to_pickle (self, fp=None, verbose=False, **kwargs):
@@ -242,7 +323,7 @@ class Annotation(object):
 
     #~~~~~~~PRIVATE METHODS~~~~~~~#
 
-    def _bed_parser(self, fp, compression=None, verbose=False, **kwargs):
+    def _bed_parser(self, fp, compression=None, refid_list=None, verbose=False, **kwargs):
         """
         Parse a bed formated file
         """
@@ -250,15 +331,21 @@ class Annotation(object):
         # try to import the file as a bed6 in a dataframe
         try:
             col_names = ["refid","start","end","ID","score","strand"]
-            df = pd.read_csv(fp, sep="\t", names=col_names, index_col=False, comment="#", compression=compression)
+            df = pd.read_csv(fp, sep="\t", names=col_names, index_col=False, comment="#", compression=compression,
+                engine="c", usecols=self._BED_USECOLS, dtype=self._STR_DTYPES)
             if verbose: jprint("\tSuccessfully imported as a bed6 file")
 
         # else try to import as a bed12
         except IndexError as E:
             col_names = ["refid","start","end","ID","score","strand","thickStart","thickEnd","itemRgb","blockCount","blockSizes","blockStarts"]
-            df = pd.read_csv(fp, sep="\t", names=col_names, index_col=False, comment="#", compression=compression)
+            df = pd.read_csv(fp, sep="\t", names=col_names, index_col=False, comment="#", compression=compression,
+                engine="c", usecols=self._BED_USECOLS, dtype=self._STR_DTYPES)
             if verbose: jprint("\tSuccessfully imported as a bed12 file")
 
+        # Discard the features of the other references before any further processing
+        if refid_list:
+            df = df[df["refid"].isin(refid_list)].copy()
+
         # Type is not available from bed files
         df['type'] = "."
 
@@ -266,40 +353,66 @@ class Annotation(object):
         df = self._clean_df(df, verbose=verbose)
         return df
 
-    def _gff3_parser(self, fp, compression=None, verbose=False, **kwargs):
+    def _gff3_parser(self, fp, compression=None, refid_list=None, verbose=False, **kwargs):
         """
         Parse a gff3 formated file
         """
         if verbose: jprint("\tUse GFF3 parser to parse annotations")
         # Import the file in a dataframe
         col_names = ["refid","source","type","start","end","score","strand","frame","attribute"]
-        df = pd.read_csv(fp, sep="\t", names=col_names, index_col=False, comment="#", compression=compression)
+        df = pd.read_csv(fp, sep="\t", names=col_names, index_col=False, comment="#", compression=compression,
+            engine="c", usecols=self._GFF_USECOLS, dtype=self._STR_DTYPES)
 
-        # Extract the ID field = first field of attribute
-        df['ID'] = df["attribute"].str.split(';').str[0].str[3:]
+        # Discard the features of the other references before any further processing
+        if refid_list:
+            df = df[df["refid"].isin(refid_list)].copy()
+
+        # Extract the ID field = first field of attribute without the 3 characters "ID=" prefix, in a single regex pass
+        df['ID'] = df["attribute"].str.extract(r'^[^;]{0,3}([^;]*)', expand=False)
+        del df["attribute"]
         if verbose: jprint("\tSuccessfully imported as a gff3 file")
 
         # Clean df
         df = self._clean_df(df, verbose=verbose)
         return df
 
-    def _gtf_parser(self, fp, compression=None, verbose=False, **kwargs):
+    def _gtf_parser(self, fp, compression=None, refid_list=None, verbose=False, **kwargs):
         """
         Parse a gtf formated file
         """
         if verbose: jprint("\tUse GTF parser to parse annotations")
         # Import the file in a dataframe
         col_names = ["refid","source","type","start","end","score","strand","frame","attribute"]
-        df = pd.read_csv(fp, sep="\t", names=col_names, index_col=False, comment="#", compression=compression)
+        df = pd.read_csv(fp, sep="\t", names=col_names, index_col=False, comment="#", compression=compression,
+            engine="c", usecols=self._GFF_USECOLS, dtype=self._STR_DTYPES)
+
+        # Discard the features of the other references before any further processing
+        if refid_list:
+            df = df[df["refid"].isin(refid_list)].copy()
 
-        # Extract the ID field = first field of attribute=
-        df['ID'] = df["attribute"].str.split('\"').str[1]
+        # Extract the ID field = first quoted field of attribute, in a single regex pass
+        df['ID'] = df["attribute"].str.extract(r'"([^"]*)', expand=False)
+        del df["attribute"]
         if verbose: jprint("\tSuccessfully imported as a gtf file")
 
         # Clean df
         df = self._clean_df(df, verbose=verbose)
         return df
 
+    def _get_refid_index (self, **kwargs):
+        """
+        Return a dict containing for each refid the row positions, start and end coordinates and running maximum of
+        the end coordinates of its features. The dict is built once and invalidated each time the feature dataframe
+        is modified. Its keys also give the list of refids without scanning the dataframe
+        """
+        if self._refid_index is None:
+            starts = self.feature_df["start"].values
+            ends = self.feature_df["end"].values
+            self._refid_index = {}
+            for refid_name, rows in self.feature_df.groupby("refid", sort=False, observed=True).indices.items():
+                self._refid_index[refid_name] = (rows, starts[rows], ends[rows], np.maximum.accumulate(ends[rows]))
+        return self._refid_index
+
     def _clean_df (self, df, verbose=False, **kwargs):
         """
         Clean dataframe after parsing
@@ -314,10 +427,16 @@ class Annotation(object):
         if verbose: jprint("\tRemoved {} invalid lines".format(l-len(df)))
 
         # Cast the start and end field in integer
-        if verbose: jprint("\tCast coordinates to integer and id to str")
-        df[['start', 'end']] = df[['start', 'end']].astype(int)
+        if verbose: jprint("\tCast coordinates to integer, id to str and other text fields to category")
+        # 32 bits coordinates are used unless a reference is too long to fit in
+        coord_dtype = np.int32 if df["end"].max() <= np.iinfo(np.int32).max else np.int64
+        df[['start', 'end']] = df[['start', 'end']].astype(coord_dtype)
         df[['ID']] = df[['ID']].astype(str)
 
+        # Low cardinality text fields are stored as categories
+        for field in ["refid", "strand", "type"]:
+            df[field] = df[field].astype("category")
+
         # Verify than the dataframe is not empty
         if df.empty:
             raise ValueError("No valid features imported. Is the file valid?")
@@ -331,3 +450,30 @@ class Annotation(object):
         if verbose: jprint ("\tTry to load as a pickle file")
         df = pd.read_pickle(fp)
         return df
+
+    def _load_cache(self, fp, cache_fp, verbose=False, **kwargs):
+        """
+        Load the features from a cache file written by a previous run. Return None if the cache file is missing, older
+        than fp, unreadable or written with another version of the cache layout
+        """
+        if not isfile(cache_fp) or getmtime(cache_fp) <= getmtime(fp):
+            return None
+        if verbose: jprint ("\tTry to load cached features from {}".format(cache_fp))
+        try:
+            cache = pd.read_pickle(cache_fp)
+        except Exception:
+            cache = None
+        if not isinstance(cache, dict) or cache.get("version") != self._CACHE_VERSION:
+            if verbose: jprint ("\tThe cache file is outdated and will be rewritten")
+            return None
+        return cache["feature_df"]
+
+    def _write_cache(self, cache_fp, verbose=False, **kwargs):
+        """
+        Write the parsed features in a cache file with the version of the cache layout. Only warn if it fails
+        """
+        if verbose: jprint("\tWrite parsed features in cache file {}".format(cache_fp))
+        try:
+            pd.to_pickle({"version":self._CACHE_VERSION, "feature_df":self.feature_df}, cache_fp)
+        except OSError as E:
+            warnings.warn("Cannot write the cache file {}: {}".format(cache_fp, E))
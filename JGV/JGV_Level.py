@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
 
 # Strandard library imports
-from collections import OrderedDict, namedtuple, Counter
+from collections import namedtuple, Counter
+from heapq import heappush, heappop
 
 #~~~~~~~CLASS~~~~~~~#
 class Level (object):
     """
     Compute the level of a given feature on the Annotation track to avoid annotation overlaping
     """
+    # Type of the returned features, created once for all the instances
+    enhanced_feature = namedtuple('enhanced_feature', ['ID','start', 'end', "arrowstyle", "level"])
 
     #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
     def __init__ (self,
@@ -42,21 +45,32 @@ class Level (object):
 
         # Create self containers
         self.level_dict={}
-        self.count = Counter()
-        self.enhanced_feature = namedtuple('enhanced_feature', ['ID','start', 'end', "arrowstyle", "level"])
+        self.n_all = self.n_pos = self.n_neg = self.n_unstrand = 0
+        # Heaps of (end, level) for the occupied levels and of free levels, for each strand. Levels of the negative
+        # strand are stored as positive indices
+        self._busy = {"+":[], "-":[]}
+        self._free = {"+":[], "-":[]}
 
     def __str__(self):
         """readable description of the object"""
         msg = "{} instance\n".format(self.__class__.__name__)
 
-        # list all values in object dict in alphabetical order
-        for k,v in OrderedDict(sorted(self.__dict__.items(), key=lambda t: t[0])).items():
-            msg+="\t{}\t{}\n".format(k, v)
+        # list all public values in object dict in alphabetical order
+        for k,v in sorted(self.__dict__.items(), key=lambda t: t[0]):
+            if not k.startswith("_"):
+                msg+="\t{}\t{}\n".format(k, v)
         return (msg)
 
     def __repr__ (self):
         return ("{}".format(self.__class__.__name__))
 
+    @property
+    def count(self):
+        """Return a Counter of the number of features analysed, overall and per strand"""
+        counts = (("all_features", self.n_all), ("positive_features", self.n_pos), ("negative_features", self.n_neg),
+            ("unstranded_features", self.n_unstrand))
+        return Counter({k:v for k,v in counts if v})
+
     @property
     def min_level(self):
         """Return the minimal level index"""
@@ -87,35 +101,71 @@ class Level (object):
         * strand
             Strand of the feature. Can be + - or . if unknown
         """
-        self.count["all_features"] +=1
+        self.n_all +=1
 
         # For features on the positive strand
         if strand == "+" and not self.filter_pos:
-            level=1
-            self.count["positive_features"] +=1
-
-            while level <= self.max_depth:
-                # If level is empty or if the level is free at this position
-                if level not in self.level_dict or (self.level_dict[level]+self.offset) < start:
-                    self.level_dict[level] = end
-                    return self.enhanced_feature (ID, start, end, self.pos_arrowstyle, level)
-                level+=1
+            self.n_pos +=1
+            level = self._get_level(strand, start, end)
+            if level:
+                return self.enhanced_feature (ID, start, end, self.pos_arrowstyle, level)
 
         # For features on the negative strand
         elif strand == "-" and not self.filter_neg:
-            level=-1
-            self.count["negative_features"] +=1
-
-            while level >= -self.max_depth:
-                # If level is empty or if the level is free at this position
-                if level not in self.level_dict or (self.level_dict[level]+self.offset) < start:
-                    self.level_dict[level] = end
-                    return self.enhanced_feature (ID, start, end, self.neg_arrowstyle, level)
-                level-=1
+            self.n_neg +=1
+            level = self._get_level(strand, start, end)
+            if level:
+                return self.enhanced_feature (ID, start, end, self.neg_arrowstyle, -level)
 
         elif strand == "." and not self.filter_unstrand:
-            self.count["unstranded_features"] +=1
+            self.n_unstrand +=1
             self.level_dict[0] = end
             return self.enhanced_feature (ID, start, end, self.unstrand_arrowstyle, 0)
 
         return None
+
+    def assign_levels (self, IDs, starts, ends, strands):
+        """
+        Compute the levels of a batch of annotation features sorted by start coordinates and return the list of the
+        enhanced features that were not filtered out, in the same order.
+        * IDs
+            List of names of the features
+        * starts
+            List of start coordinates of the features, on the positive strand
+        * ends
+            List of end coordinates of the features, on the positive strand
+        * strands
+            List of strands of the features. Can be + - or . if unknown
+        """
+        level_fun = self.__call__
+        enhanced_features = []
+        for ID, start, end, strand in zip(IDs, starts, ends, strands):
+            fl = level_fun (ID, start, end, strand)
+            if fl:
+                enhanced_features.append(fl)
+        return enhanced_features
+
+    #~~~~~~~PRIVATE METHODS~~~~~~~#
+    def _get_level (self, strand, start, end):
+        """
+        Return the lowest free level index for a feature of the given strand, or None if max_depth is reached. As the
+        features are sorted by start, a level freed for a given start is also free for all the following features. The
+        ended levels are thus moved from the busy heap to the free heap, instead of scanning all the levels
+        """
+        busy = self._busy[strand]
+        free = self._free[strand]
+        offset = self.offset
+        while busy and (busy[0][0]+offset) < start:
+            heappush (free, heappop(busy)[1])
+
+        # Reuse the lowest free level or create a new one
+        if free:
+            level = heappop(free)
+        else:
+            level = len(busy)+1
+            if level > self.max_depth:
+                return None
+
+        heappush (busy, (end, level))
+        self.level_dict[level if strand == "+" else -level] = end
+        return level
@@ -3,6 +3,7 @@
 # Strandard library imports
 from collections import OrderedDict, Counter, namedtuple
 from os import access, R_OK
+from os.path import isfile, getmtime
 import gzip
 import csv
 
@@ -24,7 +25,8 @@ class Reference(object):
             with the refid and the length in bases (like a .fa.fai file generated by samtools faidx, or with the
             output_index option of this function)
             The fasta option will take more time as the file has to be parsed to get the refid and length of sequences.
-            Both fasta and infex file can be gziped
+            Both fasta and infex file can be gziped. If a samtools faidx index (fp+".fai") more recent than the fasta
+            file exists, it is used instead of parsing the fasta file
         *  name
             Name of the data file that will be used as track name for plotting. If not given, will be deduced from fp
             file name
@@ -42,51 +44,40 @@ class Reference(object):
         self.name = name if name else file_basename(fp)
         self.ext = extensions_list(fp)[0]
 
+        # If the fasta file was already indexed with samtools faidx, read the index instead of parsing the fasta file
+        fai_fp = fp+".fai"
+        if self.ext in ["fa", "fasta"] and isfile(fai_fp) and getmtime(fai_fp) >= getmtime(fp):
+            if verbose: jprint ("Use the fasta index file {}".format(fai_fp))
+            self.d = self._index_parser(fai_fp, refid_list)
+
         # If the file is in fasta format
-        if self.ext in ["fa", "fasta"]:
+        elif self.ext in ["fa", "fasta"]:
             if verbose: jprint ("Parsing fasta file")
 
-            # File handling for both uncompressed or compressed fasta file
-            if fp.endswith(".gz"):
-                open_fun, open_mode = gzip.open, "rt"
-            else:
-                open_fun, open_mode = open, "r"
-
             # Parse fasta file refid and count the length of each sequence if in the refid_list
-            with open_fun(fp, open_mode) as f:
-                d = OrderedDict()
-                last_ref = None
-                for l in f:
-                    if l.startswith(">"):
-                        refid = l[1:].split()[0].strip()
-                        if not refid_list or refid in refid_list:
-                            d[refid] = 0
-                            last_ref = refid
-                        else:
-                            last_ref = None
-                    elif last_ref:
-                        d[last_ref] += len(l.strip())
-            
-            # Check if sequences found 
-            assert d, "No Sequence found"
-            
+            d = self._fasta_parser(fp, refid_list)
+
             # Transform the counter in a Dataframe and sort by length
             self.d = pd.Series(d, name="length", dtype = "int64")
             self.d.sort_values(inplace=True, ascending=False)
 
+        # In the case the file is not in fasta format, try to parse it as a 2 columns tabulated file with refid and length for each sequence
+        else:
+            if verbose: jprint ("Assume the file is a fasta index")
+            self.d = self._index_parser(fp, refid_list)
+
+        if self.ext in ["fa", "fasta"]:
+            # Check if sequences found, from either the fasta file or its index
+            assert not self.d.empty, "No Sequence found"
+
             # Write the index in a file for quicker loading next time
             if output_index:
                 index_file = "{}/{}.tsv".format(dir_path(fp), file_basename(fp))
                 if verbose: jprint ("Write a fasta index file: {}".format(index_file))
-                self.d.to_csv(index_file, sep="\t")
+                self.d.to_csv(index_file, sep="\t", header=False)
 
-        # In the case the file is not in fasta format, try to parse it as a 2 columns tabulated file with refid and length for each sequence
-        else:
-            if verbose: jprint ("Assume the file is a fasta index")
-            self.d = pd.read_csv(fp, sep="\t", squeeze=True, comment="#",  usecols=[0,1], index_col=0, header=None)
-            if refid_list: self.d = self.d[(self.d.index.isin(refid_list))]
-            self.d.name= "length"
-            self.d.sort_values(inplace=True, ascending=False)
+        # Plain dict of the lengths for quick lookups by refid
+        self._refid_len = self.d.to_dict()
 
         if verbose:
             jprint ("\tFound {} reference sequences".format(self.refid_count))
@@ -108,8 +99,80 @@ class Reference(object):
     #~~~~~~~PUBLIC METHODS~~~~~~~#
     def get_refid_len (self, refid, verbose=False, **kwargs):
         """ Return the length of a given refid, If the reference is not found return None"""
-        if refid not in self.d:
+        if refid not in self._refid_len:
             if verbose: jprint ("The reference sequence {} was not found in the reference list".format(refid))
             return None
         else:
-            return self.d[refid]
+            return self._refid_len[refid]
+
+    #~~~~~~~PRIVATE METHODS~~~~~~~#
+    def _index_parser (self, fp, refid_list=[], **kwargs):
+        """
+        Return a Series of the reference sequence lengths sorted by decreasing length from a tabulated index file
+        """
+        d = pd.read_csv(fp, sep="\t", comment="#",  usecols=[0,1], index_col=0, header=None, dtype={0:str, 1:"int64"},
+            engine="c").iloc[:,0]
+        if refid_list: d = d[(d.index.isin(refid_list))]
+        d.name= "length"
+        d.index.name = None
+        return d.sort_values(ascending=False)
+
+    def _fasta_parser (self, fp, refid_list=[], buf_size=1048576, **kwargs):
+        """
+        Return an ordered dict of the reference sequence ids and lengths of a fasta file, compressed or not. The file is
+        read in binary chunks of buf_size bytes and the sequence lengths are computed from the size of the blocks found
+        between headers minus their line breaks, instead of iterating over every single line
+        """
+        # File handling for both uncompressed or compressed fasta file
+        open_fun = gzip.open if fp.endswith(".gz") else open
+
+        # Hash the selected refids once for the header tests
+        refid_set = set(refid_list) if refid_list else None
+
+        d = OrderedDict()
+        last_ref = None
+        header = None
+        line_start = True
+        with open_fun(fp, "rb") as f:
+            for chunk in iter(lambda: f.read(buf_size), b""):
+                pos = 0
+                while pos < len(chunk):
+                    # Complete a header line, possibly started in the previous chunk
+                    if header is not None:
+                        header_end = chunk.find(b"\n", pos)
+                        if header_end == -1:
+                            header += chunk[pos:]
+                            break
+                        header += chunk[pos:header_end]
+                        refid = header.split()[0].decode()
+                        if refid_set is None or refid in refid_set:
+                            d[refid] = 0
+                            last_ref = refid
+                        else:
+                            last_ref = None
+                        header = None
+                        pos = header_end+1
+                        line_start = True
+                        continue
+
+                    # Find the next header, and count the sequence bases found before it
+                    if line_start and chunk[pos:pos+1] == b">":
+                        header_start = pos
+                    else:
+                        header_start = chunk.find(b"\n>", pos)
+                        header_start = len(chunk) if header_start == -1 else header_start+1
+                        if last_ref:
+                            seq = chunk[pos:header_start]
+                            d[last_ref] += len(seq) - seq.count(b"\n") - seq.count(b"\r")
+                        if header_start == len(chunk):
+                            line_start = chunk.endswith(b"\n")
+                            break
+                    header = b""
+                    pos = header_start+1
+
+        # Last header without sequence nor line break
+        if header is not None:
+            refid = header.split()[0].decode()
+            if refid_set is None or refid in refid_set:
+                d[refid] = 0
+        return d
@@ -17,7 +17,7 @@ __classifiers__ = [
     'Programming Language :: Python :: 3.4',
     'Programming Language :: Python :: 3.5',
     'Programming Language :: Python :: 3.6',]
-__install_requires__ = ['numpy>=1.11.1', 'pandas>=0.18.1', 'matplotlib>=1.5.1', 'pysam>= 0.9.0', 'notebook>=4.0.0', 'pycl>=1.0.3']
+__install_requires__ = ['numpy>=1.15.0', 'pandas>=0.24.0', 'matplotlib>=1.5.1', 'pysam>=0.15.0', 'notebook>=4.0.0', 'pycl>=1.0.3']
 __dependency_links__ = ['https://github.com/a-slide/pycl/archive/1.0.3.tar.gz#egg=pycl-1.0.3']
 __package_data__ =  ['data/yeast.bam', 'data/yeast.fa.gz', "data/yeast.gtf.gz", "data/yeast.gff3.gz", "JGV_Test_Notebook.ipynb"]
 __python_requires__='>=3'